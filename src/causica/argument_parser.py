@@ -167,6 +167,23 @@ def get_parser() -> argparse.ArgumentParser:
         type=float,
         help="Base Learning rate",
     )
+    parser.add_argument(
+        "--max_parallel_jobs",
+        "-mpj",
+        type=int,
+        default=1,
+        help="Number of configs of a sweep to run in parallel locally. With --device gpu (or 0), the runs are spread "
+        "over all visible GPUs. Default: %(default)s (serial).",
+    )
+    parser.add_argument(
+        "--precision",
+        "-p",
+        type=str.lower,
+        choices=["fp32", "bf16", "fp16", "auto"],
+        help="Precision of the training steps (mixed precision with torch.autocast for bf16/fp16, fp16 is CUDA only). "
+        "'auto' uses bf16 on CUDA devices supporting it (Ampere or newer) and fp32 otherwise. "
+        "If not provided, the precision is taken from the training config, which defaults to fp32.",
+    )
     return parser
 
 
@@ -183,3 +200,6 @@ def validate_args(args: argparse.Namespace) -> None:
     for config in (args.model_config, args.dataset_config, args.impute_config, args.objective_config):
         if config is not None and not os.path.isfile(config):
             raise ValueError(f"Config file {config} does not exist.")
+
+    if args.max_parallel_jobs < 1:
+        raise ValueError(f"max_parallel_jobs must be at least 1, got {args.max_parallel_jobs}.")
@@ -5,6 +5,10 @@ def mock_download_dataset(dataset_name: str, data_dir: str):
     raise NotImplementedError("No download_dataset functionality provided")
 
 
+def is_not_azureml_run() -> bool:
+    return False
+
+
 def aml_step(func: Callable, _: bool) -> Callable:
     return func
 
@@ -20,7 +24,8 @@ class RunContext:
         # Function for downloading the dataset
         self.download_dataset = mock_download_dataset
         # Function for saying whether it is aml run or not
-        self.is_azureml_run = lambda: False
+        # (module-level function rather than a lambda, so that the run context can be pickled to worker processes)
+        self.is_azureml_run = is_not_azureml_run
         # Evaluation pipeline used for a run
         # If no evaluation pipeline used, None is passed
         self.pipeline = None  # type:ignore
@@ -82,6 +82,8 @@ class ExperimentArguments:
     run_context: RunContext
     eval_likelihood: bool = True
     conversion_type: str = "full_time"
+    # ID to give to the newly trained model (a new one is generated if None). Unused if model_id is given.
+    train_model_id: Optional[str] = None
 
 
 def run_single_seed_experiment(args: ExperimentArguments):
@@ -140,6 +142,7 @@ def run_single_seed_experiment(args: ExperimentArguments):
             device=args.device,
             model_config=args.model_config,
             train_hypers=args.train_hypers,
+            model_id=args.train_model_id,
         )
         running_times["train/running-time"] = (time.time() - start_time) / 60
     save_json(args.dataset_config, os.path.join(model.save_dir, "dataset_config.json"))
@@ -1,5 +1,5 @@
 from logging import Logger
-from typing import Any, Dict, Union
+from typing import Any, Dict, Optional, Union
 
 import mlflow
 
@@ -20,11 +20,12 @@ def run_train_main(
     device: str,
     model_config: Dict[str, Any],
     train_hypers: Dict[str, Any],
+    model_id: Optional[str] = None,
 ) -> IModel:
 
     # Create model
     logger.info("Creating new model")
-    model = create_model(model_type, output_dir, variables, device, model_config)
+    model = create_model(model_type, output_dir, variables, device, model_config, model_id=model_id)
     if isinstance(model, TorchModel):
         num_trainable_parameters = sum(p.numel() for p in model.parameters())
         mlflow.set_tags({"num_trainable_parameters": num_trainable_parameters})
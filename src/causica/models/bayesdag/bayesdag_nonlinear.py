@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import contextlib
 import os
 from collections import defaultdict, deque
-from typing import Any, Callable, Dict, Optional, Tuple
+from typing import Any, Callable, ContextManager, Dict, Optional, Tuple
 
 import numpy as np
 import torch
@@ -15,7 +16,7 @@ from ...datasets.dataset import CausalDataset, Dataset
 from ...datasets.variables import Variables
 from ...preprocessing.data_processor import DataProcessor
 from ...utils.helper_functions import to_tensors, fill_triangular
-from ...utils.torch_utils import generate_fully_connected
+from ...utils.torch_utils import generate_fully_connected, get_autocast_dtype
 from ..optimizers import Adam_SGMCMC
 from .bayesdag import BayesDAG
 from .generation_functions import untranspose_stack
@@ -130,6 +131,11 @@ class BayesDAGNonLinear(BayesDAG):
         self.p_steps = 0
         self.weights_steps = 0
         self.sinkhorn_n_iter = sinkhorn_n_iter
+        # Only used when training in reduced precision (fp16 for the grad scaler), see run_train
+        self.autocast_dtype: Optional[torch.dtype] = None
+        self.grad_scaler: Optional[torch.cuda.amp.GradScaler] = None
+        # Scale the loss was multiplied by in the last backward pass, see _backward_and_step
+        self.last_grad_scale = 1.0
         self.num_burnin_steps = 1
         self.p = self.p_scale * torch.randn((self.num_chains, self.num_nodes), device=self.device)
         self.p.requires_grad = True
@@ -163,19 +169,23 @@ class BayesDAGNonLinear(BayesDAG):
                     break
             return log_alpha.exp()
 
-        O = self.o_scale * torch.arange(1, self.num_nodes+1, dtype=p.dtype, device=p.device).expand(1, -1)
-        X = torch.matmul(p.unsqueeze(-1), O.unsqueeze(-2))
-        
-        perm = log_sinkhorn_norm(X / 0.2)
-        
-        perm_matrix = torch.zeros_like(perm)
-        for i in range(perm.shape[0]):
-            row_ind, col_ind = linear_sum_assignment(-perm[i].squeeze().cpu().detach().numpy())
-            perm_indices = list(zip(row_ind, col_ind))            
-            perm_indices = [(i,) + idx for idx in perm_indices]
-            perm_indices = tuple(zip(*perm_indices))
-            perm_matrix[perm_indices] = 1.0
-        perm_matrix_hard = (perm_matrix - perm).detach() + perm # Straight Through
+        # Always in fp32: the Sinkhorn normalisation is sensitive to precision, and numpy (for linear_sum_assignment)
+        # doesn't support bf16
+        with self._autocast(enabled=False):
+            p = p.float()
+            O = self.o_scale * torch.arange(1, self.num_nodes+1, dtype=p.dtype, device=p.device).expand(1, -1)
+            X = torch.matmul(p.unsqueeze(-1), O.unsqueeze(-2))
+
+            perm = log_sinkhorn_norm(X / 0.2)
+
+            perm_matrix = torch.zeros_like(perm)
+            for i in range(perm.shape[0]):
+                row_ind, col_ind = linear_sum_assignment(-perm[i].squeeze().cpu().detach().numpy())
+                perm_indices = list(zip(row_ind, col_ind))
+                perm_indices = [(i,) + idx for idx in perm_indices]
+                perm_indices = tuple(zip(*perm_indices))
+                perm_matrix[perm_indices] = 1.0
+            perm_matrix_hard = (perm_matrix - perm).detach() + perm # Straight Through
         return perm_matrix_hard, perm
     
     def transform_adj(self, p: torch.Tensor, detach_W: bool = False):
@@ -318,12 +328,12 @@ class BayesDAGNonLinear(BayesDAG):
             self.weights_opt.zero_grad()
             self.W_opt.zero_grad()
             self.p_opt.zero_grad()
-            A_samples = self.transform_adj(self.p, detach_W=False)
-            ll_eltwise, _, p_prior, sparse_loss = self.data_likelihood(data, A_samples, dataset_size=dataset_size, use_param_weights=True, return_prior=True)
-            loss = -(ll_eltwise+p_prior+1*sparse_loss).mean()  # 1 averaged over num_chains, batch sizes
+            with self._autocast():
+                A_samples = self.transform_adj(self.p, detach_W=False)
+                ll_eltwise, _, p_prior, sparse_loss = self.data_likelihood(data, A_samples, dataset_size=dataset_size, use_param_weights=True, return_prior=True)
+                loss = -(ll_eltwise+p_prior+1*sparse_loss).mean()  # 1 averaged over num_chains, batch sizes
             total_loss+= loss.detach()
-            loss.backward()
-            self.p_opt.step()
+            self._backward_and_step(loss, self.p_opt)
             if writer is not None:
                 for jj in range(self.p.shape[0]):
                     writer_dict = {}
@@ -355,13 +365,13 @@ class BayesDAGNonLinear(BayesDAG):
             self.weights_opt.zero_grad()
             self.W_opt.zero_grad()
             self.p_opt.zero_grad()
-            A_samples = self.transform_adj(self.p)
-            ll_eltwise, theta_prior, _, sparse_loss = self.data_likelihood(data, A_samples, dataset_size=dataset_size, use_param_weights=True, return_prior=True)# batch x chain, num_chain
-            
-            loss = -(ll_eltwise+theta_prior+sparse_loss).mean()  #[]
+            with self._autocast():
+                A_samples = self.transform_adj(self.p)
+                ll_eltwise, theta_prior, _, sparse_loss = self.data_likelihood(data, A_samples, dataset_size=dataset_size, use_param_weights=True, return_prior=True)# batch x chain, num_chain
+
+                loss = -(ll_eltwise+theta_prior+sparse_loss).mean()  #[]
             total_loss += loss.detach()
-            loss.backward()
-            self.weights_opt.step()
+            self._backward_and_step(loss, self.weights_opt)
             self.weights_steps += 1
 
             if self.weights_steps >= self.num_burnin_steps:
@@ -370,6 +380,31 @@ class BayesDAGNonLinear(BayesDAG):
                     self.buffers_buffer.append(untranspose_stack(self.icgnn_buffers, i, clone=True))
         return total_loss/num_steps
     
+    def _autocast(self, enabled: bool = True) -> ContextManager:
+        """
+        Autocast context for the forward pass and loss of a training step, in the precision set by run_train. The
+        backward pass and optimizer step should run outside of it. With enabled=False, it runs a region of such a
+        forward pass in full precision.
+        """
+        if self.autocast_dtype is None:
+            # Not torch.autocast(enabled=False), which raises for devices without autocast support (e.g. MPS)
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype, enabled=enabled)
+
+    def _backward_and_step(self, loss: torch.Tensor, optimizer: torch.optim.Optimizer) -> None:
+        """
+        Backpropagate the loss and take an optimizer step, scaling the loss to avoid underflowing gradients in fp16.
+        """
+        if self.grad_scaler is None:
+            loss.backward()
+            optimizer.step()
+        else:
+            self.grad_scaler.scale(loss).backward()
+            # Read before update() may change it. step() already synchronises with the GPU, so this doesn't add a stall.
+            self.last_grad_scale = self.grad_scaler.get_scale()
+            self.grad_scaler.step(optimizer)
+            self.grad_scaler.update()
+
     def _train_helper_network(self, data: torch.Tensor, dataset_size, num_iters: int = 1)-> torch.Tensor:
         """
         VI step for training the helper network to generate W conditioned on p.
@@ -383,13 +418,13 @@ class BayesDAGNonLinear(BayesDAG):
             self.weights_opt.zero_grad()
             self.W_opt.zero_grad()
             self.p_opt.zero_grad()
-            A_samples = self.transform_adj(self.p)
-            ll_eltwise,_,_,sparse_loss = self.data_likelihood(data, A_samples, dataset_size=dataset_size, use_param_weights=True, return_prior=True) # batch x chain
-            prior, entropy = self.compute_W_prior_entropy(self.p, dataset_size=dataset_size) # chain
-            loss = -(ll_eltwise+prior + entropy+sparse_loss).mean()  #
+            with self._autocast():
+                A_samples = self.transform_adj(self.p)
+                ll_eltwise,_,_,sparse_loss = self.data_likelihood(data, A_samples, dataset_size=dataset_size, use_param_weights=True, return_prior=True) # batch x chain
+                prior, entropy = self.compute_W_prior_entropy(self.p, dataset_size=dataset_size) # chain
+                loss = -(ll_eltwise+prior + entropy+sparse_loss).mean()  #
             total_loss += loss.detach()
-            loss.backward()
-            self.W_opt.step()
+            self._backward_and_step(loss, self.W_opt)
         return total_loss/num_iters
 
     def run_train(
@@ -402,7 +437,8 @@ class BayesDAGNonLinear(BayesDAG):
         Runs training.
         Args:
             dataset: Dataset to use.
-            train_config_dict: Dictionary with training hyperparameters.
+            train_config_dict: Dictionary with training hyperparameters. The optional "precision" entry ('fp32',
+                'bf16', 'fp16' or 'auto', default 'fp32') sets the precision of the training steps with torch.autocast.
             report_progress_callback: Optional callback function to report training progress.
         """
         if train_config_dict is None:
@@ -424,6 +460,8 @@ class BayesDAGNonLinear(BayesDAG):
         best_loss = np.inf
         self.p_opt.update_dataset_size(self.dataset_size)
         self.weights_opt.update_dataset_size(self.dataset_size)
+        self.autocast_dtype = get_autocast_dtype(train_config_dict.get("precision", "fp32"), self.device)
+        self.grad_scaler = torch.cuda.amp.GradScaler() if self.autocast_dtype == torch.float16 else None
         # Outer optimization loop
         inner_opt_count = 0
         prev_best = 0
@@ -432,7 +470,7 @@ class BayesDAGNonLinear(BayesDAG):
             
             for (x, _) in dataloader:
                 p_loss = self._posterior_p_sample(data=x, dataset_size=self.dataset_size, num_samples=1, writer=writer)
-                
+
                 W_loss = self._train_helper_network(data=x, dataset_size=self.dataset_size,num_iters=1)
                 weights_loss = self._posterior_weights_sample(data=x, dataset_size=self.dataset_size ,num_samples=1)
                 loss = (p_loss+W_loss+weights_loss)/3
@@ -492,8 +530,13 @@ class BayesDAGNonLinear(BayesDAG):
             mmd_tp =float("nan")
             o_fscore = float("nan")
 
+        p_grad_norm = torch.norm(self.p.grad).item()
+        if self.grad_scaler is not None:
+            # In fp16 the gradients are computed from the scaled loss, and p.grad isn't unscaled as p_opt doesn't step
+            # on it in the last (weights) step
+            p_grad_norm /= self.last_grad_scale
         print(
-            f"Step: {step}, loss: {loss:.2f}, shd: {shd:.2f}, o_fscore:{o_fscore:.2f}, cpdag-shd: {cpdag_shd:.2f} nnz: {nnz:.2f} NLL-Validation: {nll_val:.4f} NLL-Train: {nll_train:.4f} MMD-TP: {mmd_tp:.4f} P_grad_norm:{torch.norm(self.p.grad).item()}", flush=True
+            f"Step: {step}, loss: {loss:.2f}, shd: {shd:.2f}, o_fscore:{o_fscore:.2f}, cpdag-shd: {cpdag_shd:.2f} nnz: {nnz:.2f} NLL-Validation: {nll_val:.4f} NLL-Train: {nll_train:.4f} MMD-TP: {mmd_tp:.4f} P_grad_norm:{p_grad_norm}", flush=True
         )
         
         
@@ -1,5 +1,5 @@
 import os
-from typing import Any, Dict, Type, Union
+from typing import Any, Dict, Optional, Type, Union
 from uuid import uuid4
 
 
@@ -28,7 +28,7 @@ def create_model(
     variables: Variables,
     device: Union[str, int],
     model_config_dict: Dict[str, Any],
-    model_id: str = None,
+    model_id: Optional[str] = None,
 ) -> IModel:
     """
     Get an instance of an implementation of the `Model` class.
@@ -18,39 +18,172 @@ To see information about other options, run this script with -h.
 """
 
 import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import multiprocessing.context
 import os
 import sys
 import time
-from typing import Any, Dict, List, Optional, Tuple
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import mlflow
 import numpy as np
+import torch
 
 from .argument_parser import get_parser, validate_args
 from .experiment.run_aggregation import run_aggregation
 from .experiment.run_context import RunContext
 from .experiment.run_single_seed_experiment import ExperimentArguments, run_single_seed_experiment
 from .utils.configs import get_configs
+from .utils.io_utils import flatten_keys
+from .utils.mlflow_utils import (
+    enable_async_logging,
+    flush_async_logging,
+    log_batch_async,
+    raise_async_logging_errors,
+)
 from .utils.run_utils import create_models_dir, find_local_model_dir
 
 
 def split_configs(
     model_config: Dict[str, Any], dataset_config: Dict[str, Any]
-) -> List[Tuple[int, Dict[str, Any], Any, Dict[str, Any]]]:
-    split_keys = []
-    product_items = []
-    from itertools import product
-    for key, item in model_config.items():
-         if isinstance(item, list):
-            split_keys.append(key)
-            product_items.append(item)
-    configs = []
-    for items in product(*product_items):
+) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """
+    Split a model config into one config per combination of the values of its list-valued entries.
+
+    The configs are generated lazily, so that large sweeps don't need to hold all of them in memory at once. Use
+    count_split_configs to get the number of configs without generating them.
+
+    Args:
+        model_config: Model config, where any list-valued entry is taken as the values to sweep over.
+        dataset_config: Dataset config, shared by all the returned configs.
+
+    Returns:
+        Iterator of (model_config, dataset_config) tuples, one per element of the cartesian product of the list
+        values, in the same order as itertools.product. Repeated values in a list are only used once, so no two
+        returned configs are identical.
+    """
+    split_keys = [key for key, item in model_config.items() if isinstance(item, list)]
+    if not split_keys:
+        # Nothing to sweep over (e.g. interactive runs), no need for the index grid
+        yield model_config.copy(), dataset_config
+        return
+    product_items = [_unique_values(model_config[key]) for key in split_keys]
+    # (num_configs, num_split_keys) array of indices into product_items, with the last key varying fastest.
+    # np.indices builds it as a single array (the reshape and transpose are views), and its rows are iterated over
+    # directly, so no per-config Python lists are built before the first config is yielded.
+    grid_shape = [len(item) for item in product_items]
+    index_grid = np.indices(grid_shape, dtype=np.int64).reshape(len(split_keys), math.prod(grid_shape)).T
+    for indices in index_grid:
         new_model_config = model_config.copy()
-        for key, item in zip(split_keys, items):
-            new_model_config[key] = item
-        configs.append((new_model_config, dataset_config))
-    return configs
+        for key, item, idx in zip(split_keys, product_items, indices):
+            new_model_config[key] = item[idx]
+        yield new_model_config, dataset_config
+
+
+def count_split_configs(model_config: Dict[str, Any]) -> int:
+    """
+    Number of configs generated by split_configs for the given model config.
+    """
+    return math.prod(len(_unique_values(item)) for item in model_config.values() if isinstance(item, list))
+
+
+def _unique_values(values: List[Any]) -> List[Any]:
+    # Drop repeated values (keeping the first occurrence) so that e.g. "random_seed": [1, 1, 2] doesn't launch the
+    # same run twice. Values are compared by their JSON representation, since they may be unhashable (e.g. dicts).
+    seen = set()
+    unique_values = []
+    for value in values:
+        digest = hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique_values.append(value)
+    return unique_values
+
+
+def _init_pool_worker(
+    device_queue: Optional[Any], mlflow_tracking_uri: str, mlflow_run_id: Optional[str], num_threads: Optional[int]
+) -> None:
+    # Each worker claims one GPU slot before CUDA gets initialised in the process,
+    # and resumes the parent's mlflow run so that tags/metrics end up in the same place. The tracking URI is passed on
+    # explicitly, since the parent may have set it with mlflow.set_tracking_uri rather than the environment variable.
+    if device_queue is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device_queue.get())
+    os.environ["MLFLOW_TRACKING_URI"] = mlflow_tracking_uri
+    if mlflow_run_id is not None:
+        os.environ["MLFLOW_RUN_ID"] = mlflow_run_id
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+
+def _run_single(**kwargs):
+    return run_single_seed_experiment(ExperimentArguments(**kwargs))
+
+
+def _run_single_seed_experiment_in_worker(kwargs_dict: Dict[str, Any]) -> None:
+    # The trained model is saved to disk by the run itself, so don't pickle it back to the parent process.
+    _run_single(**kwargs_dict)
+
+
+def _create_process_pool(max_parallel_jobs: int, device: str) -> Tuple[ProcessPoolExecutor, bool]:
+    """
+    Create a process pool for running single seed experiments in parallel on the local machine.
+
+    If the default GPU is requested (device 'gpu' or 0), the workers are spread round-robin over all the GPUs visible
+    to this process by setting CUDA_VISIBLE_DEVICES in each worker, so that max_parallel_jobs / num_gpus jobs share
+    each GPU. Any other device is used as is by all the workers. On CPU, the cores are split between the workers rather
+    than each of them using all the cores.
+
+    Args:
+        max_parallel_jobs: Number of worker processes.
+        device: Device requested for the experiment.
+
+    Returns:
+        The process pool, and whether the workers have been assigned a GPU each (in which case the runs should use
+        device 'gpu', i.e. the first visible GPU of the worker).
+    """
+    # CUDA cannot be re-initialised in forked subprocesses, so fork the workers from a clean forkserver process which
+    # has already imported this module (and so torch, numpy, numba, ...), rather than paying for the imports in each
+    # spawned worker. The forkserver start method isn't available on all platforms (e.g. Windows).
+    mp_context: multiprocessing.context.BaseContext
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("forkserver")
+        # Preload this module under the name it was imported as (e.g. causica.run_experiment, or
+        # open_source.causica.run_experiment from the root entry point), so that the workers' pickled functions resolve
+        # to the preloaded module. __name__ is "__main__" when run with python -m, while __spec__.name is not.
+        mp_context.set_forkserver_preload([__spec__.name if __spec__ is not None else __name__])
+    else:
+        mp_context = multiprocessing.get_context("spawn")
+    visible_gpus = _get_visible_gpus() if str(device) in ("gpu", "0") else []
+    device_queue = None
+    if visible_gpus:
+        device_queue = mp_context.Queue()
+        for job_idx in range(max_parallel_jobs):
+            device_queue.put(visible_gpus[job_idx % len(visible_gpus)])
+    active_run = mlflow.active_run()
+    mlflow_run_id = active_run.info.run_id if active_run is not None else None
+    num_threads = max(1, (os.cpu_count() or 1) // max_parallel_jobs) if str(device) == "cpu" else None
+    executor = ProcessPoolExecutor(
+        max_workers=max_parallel_jobs,
+        mp_context=mp_context,
+        initializer=_init_pool_worker,
+        initargs=(device_queue, mlflow.get_tracking_uri(), mlflow_run_id, num_threads),
+    )
+    return executor, bool(visible_gpus)
+
+
+def _get_visible_gpus() -> List[str]:
+    # CUDA_VISIBLE_DEVICES entries of the GPUs this process can use. The workers' CUDA_VISIBLE_DEVICES must be picked
+    # from these rather than counted from 0, which would be the first physical GPU rather than the first visible one.
+    num_gpus = torch.cuda.device_count()
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is None:
+        return [str(idx) for idx in range(num_gpus)]
+    return [entry.strip() for entry in visible_devices.split(",") if entry.strip()][:num_gpus]
 
 
 def run_experiment(
@@ -88,6 +221,8 @@ def run_experiment(
     eval_likelihood: bool = True,
     conversion_type: str = "full_time",
     delete_kwargs_files: bool = True,
+    max_parallel_jobs: int = 1,
+    precision: Optional[str] = None,
 ):
     print(f"Datset is: {dataset_name}, Model Type: {model_type}")
     if active_learning_users_to_plot is None:
@@ -112,6 +247,8 @@ def run_experiment(
         train_hypers["learning_rate"] = lr
     if lambda_sparse is not None:
         model_config["lambda_sparse"] = lambda_sparse
+    if precision is not None:
+        train_hypers["precision"] = precision
 
     # Create directories, record arguments and configs
     try:
@@ -121,7 +258,7 @@ def run_experiment(
         time.sleep(1)
         models_dir = create_models_dir(output_dir=output_dir, name=name)
     experiment_name = f"{dataset_name}.{model_type}" if name is None else name
-    aml_tags = {
+    aml_tags: Dict[str, Any] = {
         "model_type": model_type,
         "dataset_name": dataset_name,
         "model_config_path": model_config_path,
@@ -135,101 +272,154 @@ def run_experiment(
         "treatment_effects": treatment_effects,
         "device": device,
         "run_train": model_id is None,
-        "model_config": model_config,
-        "dataset_config": dataset_config,
-        "train_hypers": train_hypers,
     }
-    mlflow.set_tags(aml_tags)
 
     # Make many model files with diff seed for each.
     configs = split_configs(model_config, dataset_config)
-    mlflow.set_tags({"num_samples": len(configs)})
-
-    pipeline = run_context.pipeline
-    pipeline_creation_mode = pipeline is not None
-    if pipeline_creation_mode:
-        train_step_outputs: List[Any] = []
-
-    kwargs_files: List[str] = []
-
-    for model_config, dataset_config in configs:
-        kwargs_dict = dict(
-            dataset_name=dataset_name,
-            data_dir=data_dir,
-            model_type=model_type,
-            model_dir=model_dir,
-            model_id=model_id,
-            run_inference=run_inference,
-            extra_eval=extra_eval,
-            active_learning=active_learning,
-            max_steps=max_steps,
-            max_al_rows=max_al_rows,
-            causal_discovery=causal_discovery,
-            latent_confounded_causal_discovery=latent_confounded_causal_discovery,
-            treatment_effects=treatment_effects,
-            device=device,
-            quiet=quiet,
-            active_learning_users_to_plot=active_learning_users_to_plot,
-            tiny=tiny,
-            dataset_config=dataset_config,
-            dataset_seed=dataset_config["random_seed"],
-            model_config=model_config,
-            train_hypers=train_hypers,
+    num_configs = count_split_configs(model_config)
+    aml_tags["num_samples"] = num_configs
+    executor: Optional[ProcessPoolExecutor] = None
+    futures: List[Future] = []
+    succeeded = False
+    try:
+        # Each mlflow call is a round-trip to the tracking server, so log all the tags in one batch, in the background.
+        # The full configs are logged to the sweep's run only, rather than also being part of aml_tags, since aml_tags
+        # is passed to (and serialized for) every single seed experiment, which already gets its own configs. They are
+        # logged as tags rather than params, since mlflow refuses to change a param and a run may contain several
+        # sweeps.
+        config_tags = flatten_keys(
+            {"model_config": model_config, "dataset_config": dataset_config, "train_hypers": train_hypers}
+        )
+        log_batch_async({**aml_tags, **config_tags})
+
+        pipeline = run_context.pipeline
+        pipeline_creation_mode = pipeline is not None
+        if pipeline_creation_mode:
+            train_step_outputs: List[Any] = []
+
+        kwargs_files: List[str] = []
+        # Directories of the models trained by the single seed experiments, to be aggregated
+        input_dirs: List[str] = []
+
+        # AML pipelines already run the steps in parallel remotely, so only use a local pool otherwise.
+        # A single config is run inline, rather than paying for starting a worker process.
+        use_process_pool = not pipeline_creation_mode and max_parallel_jobs > 1 and num_configs > 1
+        if use_process_pool:
+            executor, assign_gpu_per_worker = _create_process_pool(max_parallel_jobs, device)
+
+        single_seed_step = run_context.aml_step(_run_single, pipeline_creation_mode)
+        for model_config, dataset_config in configs:
+            # Fail early, rather than after training every config, if logging to the tracking server failed
+            raise_async_logging_errors()
+            # Choose the ID of the model to train here, so that we know where it will be saved
+            train_model_id = str(uuid.uuid4()) if model_id is None else None
+            if train_model_id is not None and not pipeline_creation_mode:
+                input_dirs.append(os.path.join(models_dir, train_model_id))
+            kwargs_dict = dict(
+                dataset_name=dataset_name,
+                data_dir=data_dir,
+                model_type=model_type,
+                model_dir=model_dir,
+                model_id=model_id,
+                run_inference=run_inference,
+                extra_eval=extra_eval,
+                active_learning=active_learning,
+                max_steps=max_steps,
+                max_al_rows=max_al_rows,
+                causal_discovery=causal_discovery,
+                latent_confounded_causal_discovery=latent_confounded_causal_discovery,
+                treatment_effects=treatment_effects,
+                device=device,
+                quiet=quiet,
+                active_learning_users_to_plot=active_learning_users_to_plot,
+                tiny=tiny,
+                dataset_config=dataset_config,
+                dataset_seed=dataset_config["random_seed"],
+                model_config=model_config,
+                train_hypers=train_hypers,
+                output_dir=models_dir,
+                experiment_name=experiment_name,
+                model_seed=model_config["random_seed"],
+                aml_tags=aml_tags,
+                logger_level=logger_level,
+                run_context=run_context,
+                eval_likelihood=eval_likelihood,
+                conversion_type=conversion_type,
+                train_model_id=train_model_id,
+            )
+
+            if executor is not None:
+                if assign_gpu_per_worker:
+                    kwargs_dict["device"] = "gpu"
+                futures.append(executor.submit(_run_single_seed_experiment_in_worker, kwargs_dict))
+                continue
+
+            kwargs_file = single_seed_step(**kwargs_dict)
+            kwargs_files.append(kwargs_file)
+
+            if pipeline_creation_mode:
+                step_ouput = pipeline.add_step(
+                    script_name="run_experiment_step.py",  # TODO: remove
+                    arguments=["--step", "single_seed_experiment", "--kwargs", kwargs_file],
+                    step_name=experiment_name,
+                    output_dir=f"outputs{len(train_step_outputs)}",  # specifying unique output_dir, see #16728
+                )
+                train_step_outputs.append(step_ouput)
+
+        if executor is not None:
+            for future in as_completed(futures):
+                # Re-raise any exception from the worker
+                future.result()
+            executor.shutdown()
+
+        # For local runs, input_dirs are the model directories chosen above rather than found by scanning models_dir
+        # Going forward (i.e. once we use AML pipeline for local runs),
+        # inputs dirs will be explicitly specified (as they are in remote runs)
+
+        kwargs_file = run_context.aml_step(run_aggregation, pipeline_creation_mode)(
+            input_dirs=input_dirs,
             output_dir=models_dir,
             experiment_name=experiment_name,
-            model_seed=model_config["random_seed"],
             aml_tags=aml_tags,
-            logger_level=logger_level,
-            run_context=run_context,
-            eval_likelihood=eval_likelihood,
-            conversion_type=conversion_type,
         )
-
-        kwargs_file = run_context.aml_step(
-            (lambda **kwargs: run_single_seed_experiment(ExperimentArguments(**kwargs))),
-            pipeline_creation_mode,
-        )(**kwargs_dict)
         kwargs_files.append(kwargs_file)
 
         if pipeline_creation_mode:
-            step_ouput = pipeline.add_step(
+            pipeline.add_step(
                 script_name="run_experiment_step.py",  # TODO: remove
-                arguments=["--step", "single_seed_experiment", "--kwargs", kwargs_file],
+                arguments=["--step", "aggregation", "--kwargs", kwargs_file, "--input_dirs"] + train_step_outputs,
+                inputs=train_step_outputs,
                 step_name=experiment_name,
-                output_dir=f"outputs{len(train_step_outputs)}",  # specifying unique output_dir, see #16728
             )
-            train_step_outputs.append(step_ouput)
-
-    # For local runs, temporary logic to extract input dirs given models_dir
-    # Going forward (i.e. once we use AML pipeline for local runs),
-    # inputs dirs will be explicitly specified (as they are in remote runs)
-    input_dirs = [f.path for f in os.scandir(models_dir) if f.is_dir()]
-
-    kwargs_file = run_context.aml_step(run_aggregation, pipeline_creation_mode)(
-        input_dirs=input_dirs,
-        output_dir=models_dir,
-        experiment_name=experiment_name,
-        aml_tags=aml_tags,
-    )
-    kwargs_files.append(kwargs_file)
-
-    if pipeline_creation_mode:
-        pipeline.add_step(
-            script_name="run_experiment_step.py",  # TODO: remove
-            arguments=["--step", "aggregation", "--kwargs", kwargs_file, "--input_dirs"] + train_step_outputs,
-            inputs=train_step_outputs,
-            step_name=experiment_name,
-        )
-        pipeline.run(aml_tags)
-
-        if delete_kwargs_files:
-            for kwargs_file in kwargs_files:
-                os.remove(kwargs_file)
+            pipeline.run(aml_tags)
+
+            if delete_kwargs_files:
+                _delete_kwargs_files(kwargs_files)
+        succeeded = True
+    except BaseException:
+        # Don't wait for the configs that haven't started yet to be trained before reporting the error. Future.cancel is
+        # used since shutdown's cancel_futures argument needs Python >= 3.9.
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        # Surface any error from logging to the tracking server. If the sweep itself failed, the error is only logged so
+        # that it doesn't hide the sweep's exception.
+        flush_async_logging(raise_errors=succeeded)
 
     # TODO this return value is provided only for the sake of end_to_end tests. Remove it?
     return models_dir
 
 
+def _delete_kwargs_files(kwargs_files: List[str]) -> None:
+    # The files are removed concurrently, as each removal can be a slow round-trip on network storage
+    with ThreadPoolExecutor() as executor:
+        # list() to re-raise any exception from os.remove
+        list(executor.map(os.remove, kwargs_files))
+
+
 def run_experiment_on_parsed_args(args: argparse.Namespace, run_context: RunContext):
     # Expand args for active learning
     if args.active_learning is not None and "all" in args.active_learning:
@@ -242,6 +432,7 @@ def run_experiment_on_parsed_args(args: argparse.Namespace, run_context: RunCont
         args.model_id = None
 
     experiment_name = f"{args.dataset_name}.{args.model_type}" if args.name is None else args.name
+    enable_async_logging()
     with mlflow.start_run(run_name=experiment_name):
         run_experiment(
             dataset_name=args.dataset_name,
@@ -277,6 +468,8 @@ def run_experiment_on_parsed_args(args: argparse.Namespace, run_context: RunCont
             logger_level=args.logger_level,
             eval_likelihood=args.eval_likelihood,
             conversion_type=args.conversion_type,
+            max_parallel_jobs=args.max_parallel_jobs,
+            precision=args.precision,
         )
 
 
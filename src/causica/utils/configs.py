@@ -1,5 +1,7 @@
+import copy
 import itertools
 import os
+from functools import lru_cache
 from typing import Any, Dict, Optional, Tuple
 
 from ..utils.io_utils import read_json_as, recursive_update
@@ -36,8 +38,34 @@ def get_configs(
     Returns:
         Dictionaries containing:
         model_config, training_config, dataset_config, impute_config, objective_config
+
+    Note: the parsed config files are cached per set of arguments, so changes to the files on disk made while the
+    process is running are not picked up. Callers get a deep copy and are free to modify it.
     """
+    return copy.deepcopy(
+        _load_configs(
+            model_type=model_type,
+            dataset_name=dataset_name,
+            override_model_path=override_model_path,
+            override_dataset_path=override_dataset_path,
+            override_impute_path=override_impute_path,
+            override_objective_path=override_objective_path,
+            default_configs_dir=default_configs_dir,
+        )
+    )
+
 
+@lru_cache(maxsize=32)
+def _load_configs(
+    model_type: str,
+    dataset_name: Optional[str],
+    override_model_path: Optional[str],
+    override_dataset_path: Optional[str],
+    override_impute_path: Optional[str],
+    override_objective_path: Optional[str],
+    default_configs_dir: str,
+) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    # Cached implementation of get_configs. The returned dicts must not be modified, use get_configs instead.
     default_model_config_path = os.path.join(default_configs_dir, "defaults", f"model_config_{model_type}.json")
     if not os.path.exists(default_model_config_path):
         raise ModelConfigNotFound
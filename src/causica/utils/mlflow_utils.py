@@ -0,0 +1,88 @@
+"""
+Helpers for logging to mlflow without blocking on the tracking server.
+"""
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import mlflow
+from mlflow.entities import Param, RunTag
+from mlflow.tracking import MlflowClient
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of params + tags accepted by the tracking server in a single log_batch request.
+_MAX_ENTITIES_PER_BATCH = 100
+
+# A single worker keeps the logging calls in the order they were made
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mlflow_logging")
+_pending: List[Future] = []
+
+
+def enable_async_logging() -> None:
+    """
+    Make all mlflow logging calls of this process asynchronous, if the installed mlflow supports it (mlflow >= 2.10).
+    Otherwise, only the calls made through log_batch_async are asynchronous.
+    """
+    config = getattr(mlflow, "config", None)
+    if config is not None and hasattr(config, "enable_async_logging"):
+        config.enable_async_logging(True)
+
+
+def log_batch_async(tags: Dict[str, Any], params: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Log tags and params to the active mlflow run (starting one if there is none, like mlflow.set_tags does) on a
+    background thread, so that the round-trips to the tracking server overlap with whatever runs next.
+    Call raise_async_logging_errors to check for failed calls without waiting, and flush_async_logging (e.g. in a
+    finally block) before the run ends to wait for the logging to finish.
+
+    Note that mlflow refuses to change the value of a param that has already been logged to the run, so values that
+    can differ between calls for the same run should be logged as tags.
+
+    Args:
+        tags: Tags to set. Values are converted to strings.
+        params: Params to log. Values are converted to strings.
+    """
+    if params is None:
+        params = {}
+    active_run = mlflow.active_run()
+    run_id = (active_run if active_run is not None else mlflow.start_run()).info.run_id
+    # The run is referred to by ID since the fluent API's active run is not guaranteed to be shared across threads
+    entities = [RunTag(key, str(value)) for key, value in tags.items()]
+    entities += [Param(key, str(value)) for key, value in params.items()]
+    for start in range(0, len(entities), _MAX_ENTITIES_PER_BATCH):
+        batch = entities[start : start + _MAX_ENTITIES_PER_BATCH]
+        _pending.append(
+            _executor.submit(
+                MlflowClient().log_batch,
+                run_id,
+                params=[entity for entity in batch if isinstance(entity, Param)],
+                tags=[entity for entity in batch if isinstance(entity, RunTag)],
+            )
+        )
+
+
+def raise_async_logging_errors() -> None:
+    """
+    Re-raise the exception of the first logging call made by log_batch_async that has failed, if any, without waiting
+    for the calls still in progress.
+    """
+    for future in [future for future in _pending if future.done()]:
+        _pending.remove(future)
+        future.result()
+
+
+def flush_async_logging(raise_errors: bool = True) -> None:
+    """
+    Wait for all the logging calls made by log_batch_async to finish, re-raising the first exception if any failed.
+
+    Args:
+        raise_errors: Whether to re-raise the exceptions of failed calls. If False, they are only logged, e.g. so as not
+            to replace an exception that is already being handled.
+    """
+    while _pending:
+        future = _pending.pop(0)
+        if raise_errors:
+            future.result()
+        elif future.exception() is not None:
+            logger.error("Logging to mlflow failed", exc_info=future.exception())
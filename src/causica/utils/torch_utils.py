@@ -72,6 +72,33 @@ class resBlock(Module):
         return x + self.block(x)
 
 
+def get_autocast_dtype(precision: str, device: torch.device) -> Optional[torch.dtype]:
+    """
+    Get the dtype to use with torch.autocast for the requested training precision.
+
+    Args:
+        precision: One of 'fp32', 'bf16', 'fp16' or 'auto'. 'auto' picks 'bf16' on CUDA devices supporting it
+            (Ampere or newer), and 'fp32' otherwise.
+        device: Device used for training.
+
+    Returns:
+        The autocast dtype, or None if training should run in full precision (i.e. without autocast).
+    """
+    if precision == "auto":
+        precision = "bf16" if device.type == "cuda" and torch.cuda.is_bf16_supported() else "fp32"
+    if precision == "fp32":
+        return None
+    if precision == "bf16":
+        if device.type not in ("cuda", "cpu"):
+            raise ValueError(f"bf16 precision is only supported on CUDA and CPU devices, got device {device}.")
+        return torch.bfloat16
+    if precision == "fp16":
+        if device.type != "cuda":
+            raise ValueError(f"fp16 precision is only supported on CUDA devices, got device {device}.")
+        return torch.float16
+    raise ValueError(f"Unknown precision {precision}.")
+
+
 def generate_fully_connected(
     input_dim: int,
     output_dim: int,